@@ -1,72 +1,408 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import base64
-import time
+import hashlib
+import importlib.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from io import BytesIO
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# --- Third-party libraries for PDF reading (Requires 'pip install pymupdf') ---
+# PyMuPDF is C-backed and much faster than PyPDF2, so it is preferred. PyPDF2 is
+# kept as a fallback, and if neither is installed the app still works for .txt files.
+# PyMuPDF runs in a child process through the local pdf_extractor module.
+try:
+    from pdf_extractor import PdfExtractor
+    PYMUPDF_AVAILABLE = True
+except ImportError:
+    PYMUPDF_AVAILABLE = False
 
-# --- Third-party library for PDF reading (Requires 'pip install PyPDF2') ---
-# We use a try-except block to handle cases where PyPDF2 might not be installed,
-# allowing the app to still function for .txt files.
 try:
     from PyPDF2 import PdfReader
-    PDF_READER_AVAILABLE = True
+    PYPDF2_AVAILABLE = True
+except ImportError:
+    PYPDF2_AVAILABLE = False
+
+PDF_READER_AVAILABLE = PYMUPDF_AVAILABLE or PYPDF2_AVAILABLE
+if not PDF_READER_AVAILABLE:
+    st.warning("To process PDF files, please install PyMuPDF: `pip install pymupdf`")
+
+# --- Optional fast JSON codec ---
+# orjson is several times faster than the standard library on large prompts and
+# responses; json is used when it is not installed.
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
 except ImportError:
-    PDF_READER_AVAILABLE = False
-    st.warning("To process PDF files, please install PyPDF2: `pip install PyPDF2`")
+    ORJSON_AVAILABLE = False
+
+# --- Optional libraries for retrieval and the semantic answer cache ---
+# Embeddings come from a local sentence-transformers model when it is installed,
+# and from the Gemini embedding API otherwise (which only needs numpy). Without
+# numpy the app still works; the document is truncated instead of searched,
+# and every question simply goes to the API.
+try:
+    import numpy as np
+    EMBEDDINGS_AVAILABLE = True
+except ImportError:
+    EMBEDDINGS_AVAILABLE = False
+
+# sentence-transformers pulls in torch and takes seconds to import, so only its
+# presence is checked here; it is imported when the model is first loaded, and
+# the embedding API is used if that import fails.
+LOCAL_EMBEDDINGS_AVAILABLE = importlib.util.find_spec("sentence_transformers") is not None
 
 # --- Configuration ---
 # NOTE: The apiKey will be automatically injected by the environment if left as ""
 API_KEY = "" # Leave this as-is; the platform will provide it at runtime.
 GEMINI_MODEL = "gemini-2.5-flash-preview-09-2025"
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={API_KEY}"
+# Server-sent events endpoint, so the answer can be rendered while it is generated
+API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={API_KEY}"
+
+# PDF extraction: read pages as raw text blocks, skipping PyMuPDF's line-merging
+# pass. Set to False to use the slower, reading-order "text" mode instead.
+FAST_EXTRACT = True
+
+# A pathological PDF page can take minutes to extract; a page that takes longer
+# than this is skipped and the rest of the file is still read.
+PDF_PAGE_TIMEOUT_SECONDS = 2.0
+
+# Extracted text is cached across sessions; bound how many files are kept and for how long.
+EXTRACTION_CACHE_MAX_ENTRIES = 64
+EXTRACTION_CACHE_TTL_SECONDS = 60 * 60
+
+# Semantic cache: reuse a stored answer when a new question on the same document
+# is at least this similar (cosine) to a previous one.
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX_ENTRIES = 256
+
+# Truncate content if it's too long for the model's context window (used when
+# retrieval is unavailable). A safe estimate is around 250,000 characters for
+# Gemini Flash, but we'll cap it lower for robustness and faster response.
+MAX_CHARS = 150000
+
+# Retrieval: the document is split into overlapping chunks that fit the embedding
+# model's input limit (so no chunk is silently truncated when embedded), and only
+# the chunks most relevant to the question are sent, about RETRIEVAL_CONTEXT_WORDS
+# words in total. Shorter documents are sent whole and never embedded.
+RETRIEVAL_CONTEXT_WORDS = 6000
+# English text averages about 1.3 tokens per word; the rest is headroom for
+# special tokens
+RETRIEVAL_WORDS_PER_TOKEN = 0.7
+EMBEDDING_BATCH_SIZE = 32
+
+# Remote embeddings: chunks are sent in batches of up to 100 per request
+EMBEDDING_API_MODEL = "models/text-embedding-004"
+EMBEDDING_API_URL = f"https://generativelanguage.googleapis.com/v1beta/{EMBEDDING_API_MODEL}:batchEmbedContents?key={API_KEY}"
+EMBEDDING_API_BATCH_SIZE = 100
+EMBEDDING_API_DIMENSIONS = 768
+EMBEDDING_API_MAX_TOKENS = 2048
+
+# Exact-match cache: identical (document, question) pairs never reach the API twice.
+ANSWER_CACHE_MAX_ENTRIES = 512
+
+# Connection-level retries with exponential backoff for retryable errors
+# (429 Too Many Requests, 5xx server errors), honoring Retry-After when sent.
+MAX_RETRIES = 5
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+HEADERS = {
+    "Content-Type": "application/json"
+}
+
+# System instruction guides the model's behavior and role. It is the same for
+# every request, so the payload part is built once here.
+SYSTEM_PROMPT = (
+    "You are a highly efficient document analyst and summarization assistant. "
+    "Your primary goal is to answer the user's question with a clear, concise, "
+    "and accurate summary based *only* on the provided 'DOCUMENT CONTENT'. "
+    "If the information required to answer the question is not present in the content, "
+    "you MUST explicitly state, 'I could not find the answer in the provided documents.'"
+)
+SYSTEM_INSTRUCTION = {"parts": [{"text": SYSTEM_PROMPT}]}
 
 # --- Helper Functions ---
 
-def extract_text_from_file(uploaded_file):
-    """Extracts text content from uploaded .txt or .pdf files."""
-    file_extension = uploaded_file.name.split('.')[-1].lower()
+def dumps_json(obj):
+    """Serializes obj to UTF-8 JSON bytes, using orjson when available."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+def loads_json(data):
+    """Parses JSON from bytes or str, using orjson when available."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# One extractor process serves every session, so a PDF costs a message over a
+# pipe rather than starting a new interpreter.
+@st.cache_resource(show_spinner=False)
+def get_pdf_extractor():
+    """Returns the shared PyMuPDF extractor, which runs in a long-lived child process."""
+    return PdfExtractor(PDF_PAGE_TIMEOUT_SECONDS)
+
+# Cached on the file name and the SHA-256 digest of its bytes, so Streamlit reruns
+# with the same uploads skip parsing entirely. The underscore-prefixed bytes are
+# excluded from the cache key, since the digest already identifies them. A PDF
+# that cannot be opened in time raises instead of returning, so it is never cached.
+@st.cache_data(max_entries=EXTRACTION_CACHE_MAX_ENTRIES, ttl=EXTRACTION_CACHE_TTL_SECONDS, show_spinner=False)
+def extract_text_from_bytes(file_name, file_digest, _data):
+    """Extracts text from a .txt or .pdf file's bytes, wrapped in START/END OF FILE markers.
+
+    Returns (text, warnings): text is empty if nothing could be extracted, and
+    warnings lists what went wrong for display. PDF pages that take longer than
+    PDF_PAGE_TIMEOUT_SECONDS are skipped; raises TimeoutError if the PDF itself
+    cannot be opened in that time.
+    """
+    file_extension = file_name.split('.')[-1].lower()
     text = ""
+    warnings = []
 
     # .TXT file handling
     if file_extension == "txt":
-        try:
-            # Decode content as UTF-8
-            text = uploaded_file.read().decode("utf-8")
-        except Exception as e:
-            st.error(f"Error reading TXT file: {e}")
+        # Decode content as UTF-8, replacing invalid bytes so a single bad byte
+        # does not discard the whole file
+        text = _data.decode("utf-8", errors="replace")
 
-    # .PDF file handling (Requires PyPDF2)
+    # .PDF file handling (Requires PyMuPDF, or PyPDF2 as a fallback)
     elif file_extension == "pdf":
-        if PDF_READER_AVAILABLE:
+        if PYMUPDF_AVAILABLE:
+            try:
+                text, skipped_pages = get_pdf_extractor().extract(_data, FAST_EXTRACT)
+                if skipped_pages:
+                    warnings.append(
+                        f"Skipped page(s) {', '.join(map(str, skipped_pages))} of {file_name}, "
+                        f"which could not be read within {PDF_PAGE_TIMEOUT_SECONDS:.0f}s."
+                    )
+            except TimeoutError:
+                raise
+            except Exception as e:
+                warnings.append(f"Error processing PDF file {file_name}: {e}")
+        elif PYPDF2_AVAILABLE:
             try:
                 # Use BytesIO to read the uploaded file content in memory
-                pdf_reader = PdfReader(BytesIO(uploaded_file.read()))
+                pdf_reader = PdfReader(BytesIO(_data))
+                # Collect non-empty pages in a list and join once, separating pages with a
+                # newline (as in the PyMuPDF path) so words on adjacent pages don't fuse
+                pages_text = []
                 for page in pdf_reader.pages:
-                    text += page.extract_text() or ""
+                    page_text = page.extract_text()
+                    if page_text:
+                        pages_text.append(page_text)
+                text = "\n".join(pages_text)
             except Exception as e:
-                st.error(f"Error processing PDF file: {e}")
+                warnings.append(f"Error processing PDF file {file_name}: {e}")
         else:
-            st.error("Cannot process PDF. PyPDF2 is not installed.")
+            warnings.append(f"Cannot process {file_name}. Neither PyMuPDF nor PyPDF2 is installed.")
 
-    return text
+    if not text:
+        return "", warnings
+    return f"--- START OF FILE: {file_name} ---\n{text}\n--- END OF FILE: {file_name} ---\n\n", warnings
 
-def call_gemini_api(document_content, user_query):
-    """Calls the Gemini API to get a summary based on the document and query."""
-    
-    # Check if we have enough content to send
-    if not document_content or not user_query:
-        return "Please upload documents and enter a question."
+def extract_text_from_file(uploaded_file, file_digest):
+    """Extracts the marked-up text content of an uploaded .txt or .pdf file.
+
+    Returns (text, warnings), as extract_text_from_bytes does.
+    """
+    try:
+        return extract_text_from_bytes(uploaded_file.name, file_digest, uploaded_file.getvalue())
+    except TimeoutError:
+        return "", [
+            f"Opening {uploaded_file.name} took longer than {PDF_PAGE_TIMEOUT_SECONDS:.0f}s, "
+            "so it was skipped. Upload it again to retry."
+        ]
+
+# Cached as a resource so the pooled keep-alive connection survives Streamlit reruns
+# instead of re-negotiating TLS with the API on every request.
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """Returns a shared requests.Session with a connection pool and retries for the Gemini API."""
+    session = requests.Session()
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=["POST"],
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource(show_spinner=False)
+def load_embedding_model():
+    """Loads the sentence embedding model once per server process.
+
+    Returns None if sentence-transformers is installed but fails to import (for
+    example over a broken torch install), so embeddings come from the API instead.
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as e:
+        print(f"Could not import sentence-transformers, using the embedding API: {e}")
+        return None
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+def embed_texts_remote(texts):
+    """Embeds a list of strings with the Gemini batchEmbedContents endpoint."""
+    session = get_http_session()
+    vectors = np.empty((len(texts), EMBEDDING_API_DIMENSIONS), dtype=np.float32)
+
+    # One request per batch instead of one round trip per chunk
+    for start in range(0, len(texts), EMBEDDING_API_BATCH_SIZE):
+        batch = texts[start:start + EMBEDDING_API_BATCH_SIZE]
+        payload = {
+            "requests": [
+                {"model": EMBEDDING_API_MODEL, "content": {"parts": [{"text": text}]}}
+                for text in batch
+            ]
+        }
+        response = session.post(EMBEDDING_API_URL, headers=HEADERS, data=dumps_json(payload), timeout=60)
+        response.raise_for_status()
 
-    # System instruction guides the model's behavior and role
-    system_prompt = (
-        "You are a highly efficient document analyst and summarization assistant. "
-        "Your primary goal is to answer the user's question with a clear, concise, "
-        "and accurate summary based *only* on the provided 'DOCUMENT CONTENT'. "
-        "If the information required to answer the question is not present in the content, "
-        "you MUST explicitly state, 'I could not find the answer in the provided documents.'"
+        for offset, embedding in enumerate(loads_json(response.content)["embeddings"]):
+            vectors[start + offset] = embedding["values"]
+
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+def embed_texts(texts):
+    """Embeds a list of strings into L2-normalized float32 vectors."""
+    model = load_embedding_model() if LOCAL_EMBEDDINGS_AVAILABLE else None
+    if model is None:
+        return embed_texts_remote(texts)
+
+    vectors = model.encode(
+        texts,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
     )
+    # Contiguous float32 keeps similarity search to a single BLAS matrix-vector product
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+def retrieval_chunk_words():
+    """Returns the chunk size, in words, that fits the embedding model's input limit."""
+    model = load_embedding_model() if LOCAL_EMBEDDINGS_AVAILABLE else None
+    max_tokens = model.max_seq_length if model is not None else EMBEDDING_API_MAX_TOKENS
+    return max(int(max_tokens * RETRIEVAL_WORDS_PER_TOKEN), 1)
+
+def split_into_chunks(words, chunk_words, overlap_words):
+    """Splits a list of words into overlapping windows of text."""
+    if not words:
+        return []
+
+    step = chunk_words - overlap_words
+    return [
+        " ".join(words[start:start + chunk_words])
+        for start in range(0, max(len(words) - overlap_words, 1), step)
+    ]
 
+def quantize_embeddings(embeddings):
+    """Quantizes L2-normalized float32 embeddings to int8 with one scale per row.
+
+    Returns the int8 matrix and the float32 scales; row i is approximately
+    quantized[i] / scales[i].
+    """
+    max_abs = np.abs(embeddings).max(axis=1)
+    scales = (127.0 / np.maximum(max_abs, 1e-12)).astype(np.float32)
+    quantized = np.rint(embeddings * scales[:, None]).astype(np.int8)
+    return quantized, scales
+
+def build_chunk_index(document_content):
+    """Splits the document into chunks and embeds them for retrieval.
+
+    Returns (chunks, embeddings, scales, top_k), or None when the document fits in
+    top_k chunks and would be sent whole anyway. Embeddings are stored as int8 to
+    keep session state 4x smaller than float32.
+    """
+    # Checked before the embedding model is loaded, so short documents never need it
+    words = document_content.split()
+    if len(words) <= RETRIEVAL_CONTEXT_WORDS:
+        return None
+
+    chunk_words = retrieval_chunk_words()
+    top_k = max(RETRIEVAL_CONTEXT_WORDS // chunk_words, 1)
+    chunks = split_into_chunks(words, chunk_words, chunk_words // 10)
+    if len(chunks) <= top_k:
+        return None
+
+    chunk_embeddings, chunk_scales = quantize_embeddings(embed_texts(chunks))
+    return chunks, chunk_embeddings, chunk_scales, top_k
+
+def retrieve_relevant_content(query_vec, chunks, chunk_embeddings, chunk_scales, top_k):
+    """Returns the top_k chunks most similar to the question embedding, joined in document order."""
+    sims = (chunk_embeddings @ query_vec) / chunk_scales
+
+    # The chunks are re-ordered by position anyway, so a linear-time partition
+    # is enough to find the top_k without fully sorting the scores.
+    top = np.sort(np.argpartition(-sims, top_k)[:top_k])
+    return "\n\n".join(chunks[i] for i in top)
+
+def select_prompt_content(document_content, query_vec, chunk_index):
+    """Returns the document text to send with the question.
+
+    When there is a retrieval index (see build_chunk_index) and a question embedding,
+    only the most relevant chunks are sent. Documents without an index are sent as
+    they are, truncated to MAX_CHARS.
+    """
+    if chunk_index is not None and query_vec is not None:
+        try:
+            return retrieve_relevant_content(query_vec, *chunk_index)
+        except Exception as e:
+            print(f"Retrieval failed, falling back to truncation: {e}")
+
+    if len(document_content) > MAX_CHARS:
+        st.warning(f"Document content is very large ({len(document_content):,} chars). Truncating to the first {MAX_CHARS:,} characters for processing.")
+        return document_content[:MAX_CHARS]
+    return document_content
+
+def semantic_cache_lookup(doc_hash, query_vec):
+    """Returns a cached answer for a similar question on the same document, or None."""
+    cache = st.session_state.get("sem_cache")
+    if not cache:
+        return None
+
+    keys = [key for key in cache if key[0] == doc_hash]
+    if not keys:
+        return None
+
+    sims = np.stack([cache[key][0] for key in keys]) @ query_vec
+    best = int(np.argmax(sims))
+    if sims[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+
+    # Mark the hit as most recently used
+    cache.move_to_end(keys[best])
+    return cache[keys[best]][1]
+
+def semantic_cache_store(doc_hash, user_query, query_vec, answer):
+    """Stores an answer in the semantic cache, evicting the least recently used entries."""
+    if "sem_cache" not in st.session_state:
+        st.session_state["sem_cache"] = OrderedDict()
+    cache = st.session_state["sem_cache"]
+
+    key = (doc_hash, user_query)
+    cache[key] = (query_vec, answer)
+    cache.move_to_end(key)
+    while len(cache) > SEMANTIC_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+
+def request_gemini_completion(document_content, user_query, on_text=None):
+    """Streams the prompt's completion from the Gemini API and returns the generated text.
+
+    If given, on_text is called with the text received so far after every chunk.
+    Raises RuntimeError with a user-facing message if no response could be obtained.
+    """
     # Combine the document content and the user's question into a single prompt
     full_prompt = (
         f"--- DOCUMENT CONTENT ---\n\n{document_content}\n\n"
@@ -76,38 +412,115 @@ def call_gemini_api(document_content, user_query):
 
     payload = {
         "contents": [{"parts": [{"text": full_prompt}]}],
-        "systemInstruction": {"parts": [{"text": system_prompt}]},
+        "systemInstruction": SYSTEM_INSTRUCTION,
     }
 
-    headers = {
-        "Content-Type": "application/json"
-    }
-    
-    # Retry logic (Exponential Backoff) for robustness
-    max_retries = 5
-    for attempt in range(max_retries):
+    session = get_http_session()
+
+    # Retries happen in the session's adapter and only cover opening the stream;
+    # once tokens are flowing a failure is reported instead.
+    try:
+        response = session.post(API_URL, headers=HEADERS, data=dumps_json(payload), stream=True, timeout=60)
+        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+    except (requests.exceptions.RetryError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        # Only these reach here once the adapter's retries are used up
+        raise RuntimeError(f"An API error occurred after retrying: {e}")
+    except requests.exceptions.HTTPError as e:
+        # Other statuses (400, 401, 403, ...) are not retried
+        raise RuntimeError(f"The API rejected the request ({e.response.status_code}): {e}")
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"An API error occurred: {e}")
+
+    # Each server-sent event is a "data: {...}" line holding a partial response
+    text_parts = []
+    with response:
         try:
-            response = requests.post(API_URL, headers=headers, data=json.dumps(payload))
-            response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-            
-            result = response.json()
-            
-            # Extract the text content
-            text_result = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', 'No response generated.')
-            return text_result
+            for line in response.iter_lines():
+                if not line or not line.startswith(b"data:"):
+                    continue
+                result = loads_json(line[len(b"data:"):])
 
+                # Extract the text content; events without text (e.g. the final
+                # usage metadata) are skipped
+                try:
+                    text = result["candidates"][0]["content"]["parts"][0]["text"]
+                except (KeyError, IndexError, TypeError):
+                    continue
+                if text:
+                    text_parts.append(text)
+                    if on_text is not None:
+                        on_text("".join(text_parts))
         except requests.exceptions.RequestException as e:
-            if attempt < max_retries - 1 and response.status_code in [429, 500, 503]:
-                # Implement exponential backoff for retryable errors (429 Too Many Requests, 5xx server errors)
-                wait_time = 2 ** attempt
-                print(f"Attempt {attempt+1} failed ({response.status_code}). Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-            else:
-                return f"An API error occurred after {attempt + 1} attempts: {e}"
+            raise RuntimeError(f"The API response stream was interrupted: {e}")
+
+    return "".join(text_parts) or "No response generated."
+
+def answer_cache_lookup(key):
+    """Returns the cached answer for an exact (doc_hash, question) key, or None."""
+    cache = st.session_state.get("answer_cache")
+    if not cache or key not in cache:
+        return None
+
+    # Mark the hit as most recently used
+    cache.move_to_end(key)
+    return cache[key]
+
+def answer_cache_store(key, answer):
+    """Stores an answer in the exact-match cache, evicting the least recently used entries."""
+    if "answer_cache" not in st.session_state:
+        st.session_state["answer_cache"] = OrderedDict()
+    cache = st.session_state["answer_cache"]
+
+    cache[key] = answer
+    cache.move_to_end(key)
+    while len(cache) > ANSWER_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+
+def call_gemini_api(document_content, user_query, doc_hash, chunk_index=None, on_text=None):
+    """Calls the Gemini API to get a summary based on the document and query.
+
+    Repeated questions are served from the exact-match cache, and questions similar
+    to ones already asked about the same document from the semantic cache. On a
+    cache miss, the relevant part of the document (see select_prompt_content) is
+    sent and the answer is streamed, passing the partial text to on_text.
+    """
+    
+    # Check if we have enough content to send
+    if not document_content or not user_query:
+        return "Please upload documents and enter a question."
+
+    # Trap identical questions before paying for an embedding
+    query_key = user_query.strip().lower()
+    cached_answer = answer_cache_lookup((doc_hash, query_key))
+    if cached_answer is not None:
+        return cached_answer
+
+    # The question is embedded once, for both the semantic cache and retrieval
+    query_vec = None
+    if EMBEDDINGS_AVAILABLE:
+        try:
+            query_vec = embed_texts([user_query])[0]
         except Exception as e:
-            return f"An unexpected error occurred: {e}"
-            
-    return "Failed to get a response from the API after multiple retries."
+            print(f"Semantic cache and retrieval unavailable for this query: {e}")
+        else:
+            cached_answer = semantic_cache_lookup(doc_hash, query_vec)
+            if cached_answer is not None:
+                return cached_answer
+
+    prompt_content = select_prompt_content(document_content, query_vec, chunk_index)
+
+    try:
+        answer = request_gemini_completion(prompt_content, user_query, on_text)
+    except RuntimeError as e:
+        return str(e)
+    except Exception as e:
+        return f"An unexpected error occurred: {e}"
+
+    # Only successful answers reach this point, so errors are never cached
+    answer_cache_store((doc_hash, query_key), answer)
+    if query_vec is not None:
+        semantic_cache_store(doc_hash, query_key, query_vec, answer)
+    return answer
 
 
 # --- Streamlit UI ---
@@ -172,26 +585,85 @@ with st.sidebar:
     # Process files and store the combined content in session state
     document_content = ""
     if uploaded_files:
-        with st.spinner("Processing files..."):
-            all_text_chunks = []
-            for file in uploaded_files:
-                text = extract_text_from_file(file)
-                if text:
-                    all_text_chunks.append(f"--- START OF FILE: {file.name} ---\n{text}\n--- END OF FILE: {file.name} ---\n\n")
+        # Streamlit reruns the script on every interaction; the files are only
+        # hashed, extracted and indexed again when the set of uploads changes.
+        upload_key = tuple(file.file_id for file in uploaded_files)
+        if st.session_state.get('upload_key') != upload_key:
+            with st.spinner("Processing files..."):
+                # Skip files whose bytes were already uploaded under any name
+                unique_files = []
+                file_digests = []
+                seen_digests = set()
+                for file in uploaded_files:
+                    file_digest = hashlib.sha256(file.getvalue()).hexdigest()
+                    if file_digest in seen_digests:
+                        continue
+                    seen_digests.add(file_digest)
+                    unique_files.append(file)
+                    file_digests.append(file_digest)
+
+                # Extract all files concurrently; worker threads are attached to the
+                # script context so the cached extraction can run in them. PDFs are read
+                # one at a time by the shared extractor process, which the threads
+                # only wait on.
+                ctx = get_script_run_ctx()
+                with ThreadPoolExecutor(
+                    max_workers=min(8, os.cpu_count() or 1, len(unique_files)),
+                    initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+                ) as executor:
+                    results = list(executor.map(extract_text_from_file, unique_files, file_digests))
+
+                # Keep the chunks and warnings in the original upload order
+                all_text_chunks = [chunk for chunk, _ in results if chunk]
+                file_warnings = [warning for _, warnings in results for warning in warnings]
+
+                document_content = "\n".join(all_text_chunks)
+
+                # Store the derived values with the upload signature, so later reruns
+                # reuse them without touching the files
+                doc_len = len(document_content)
+                st.session_state.update(
+                    upload_key=upload_key,
+                    file_count=len(unique_files),
+                    duplicate_count=len(uploaded_files) - len(unique_files),
+                    file_warnings=file_warnings,
+                    document_content=document_content,
+                    doc_len=doc_len,
+                    doc_hash=hashlib.blake2b(document_content.encode("utf-8"), digest_size=16).hexdigest(),
+                    preview=document_content[:1000] + ("..." if doc_len > 1000 else ""),
+                )
 
-            document_content = "\n".join(all_text_chunks)
-            st.session_state['document_content'] = document_content
-            st.success(f"Successfully processed {len(uploaded_files)} file(s).")
+                # Embed the document chunks once per distinct document for retrieval
+                if EMBEDDINGS_AVAILABLE and st.session_state.get('index_doc_hash') != st.session_state['doc_hash']:
+                    try:
+                        chunk_index = build_chunk_index(document_content)
+                    except Exception as e:
+                        print(f"Could not build the retrieval index: {e}")
+                        for key in ('chunk_index', 'index_doc_hash'):
+                            st.session_state.pop(key, None)
+                    else:
+                        st.session_state['chunk_index'] = chunk_index
+                        st.session_state['index_doc_hash'] = st.session_state['doc_hash']
+        for warning in st.session_state['file_warnings']:
+            st.warning(warning)
+        st.success(f"Successfully processed {st.session_state['file_count']} file(s).")
+        if st.session_state['duplicate_count']:
+            st.info(f"Skipped {st.session_state['duplicate_count']} duplicate file(s).")
     elif 'document_content' in st.session_state:
          # Clear content if files are removed
         del st.session_state['document_content']
+        for key in (
+            'upload_key', 'file_count', 'duplicate_count', 'file_warnings', 'doc_len', 'doc_hash', 'preview',
+            'chunk_index', 'index_doc_hash',
+        ):
+            st.session_state.pop(key, None)
 
 
     # Display a preview of the processed content (collapsed)
     if 'document_content' in st.session_state and st.session_state['document_content']:
-        st.caption(f"Total characters: {len(st.session_state['document_content']):,}")
+        st.caption(f"Total characters: {st.session_state['doc_len']:,}")
         with st.expander("View Processed Text Sample (First 1000 chars)"):
-            st.code(st.session_state['document_content'][:1000] + ("..." if len(st.session_state['document_content']) > 1000 else ""), language='text')
+            st.code(st.session_state['preview'], language='text')
 
 # --- Main Area for Query and Result ---
 if 'document_content' not in st.session_state or not st.session_state['document_content']:
@@ -208,20 +680,19 @@ else:
         if not user_query:
             st.error("Please enter a question to get a summary.")
         else:
+            # The answer is rendered here while it streams in, then replaced by the result box
+            stream_placeholder = st.empty()
             with st.spinner("Analyzing document and generating summary with Gemini..."):
-                full_content = st.session_state['document_content']
-                
-                # Truncate content if it's too long for the model's context window.
-                # A safe estimate is around 250,000 characters for Gemini Flash, 
-                # but we'll cap it lower for robustness and faster response.
-                MAX_CHARS = 150000 
-                if len(full_content) > MAX_CHARS:
-                    st.warning(f"Document content is very large ({len(full_content):,} chars). Truncating to the first {MAX_CHARS:,} characters for processing.")
-                    full_content = full_content[:MAX_CHARS]
-                
                 # Call the LLM
-                summary = call_gemini_api(full_content, user_query)
+                summary = call_gemini_api(
+                    st.session_state['document_content'],
+                    user_query,
+                    st.session_state['doc_hash'],
+                    st.session_state.get('chunk_index'),
+                    on_text=stream_placeholder.markdown,
+                )
                 st.session_state['summary_result'] = summary
+            stream_placeholder.empty()
 
     # Display the result
     if 'summary_result' in st.session_state:
@@ -0,0 +1,151 @@
+import multiprocessing
+import threading
+
+import pymupdf
+
+# PyMuPDF holds the GIL for the whole of a page's get_text call and is not
+# thread-safe, so a pathological page can only be bounded by reading it in another
+# process that is terminated when it runs out of time. This lives in its own
+# module so that process can import it without running the Streamlit app.
+
+# Plain text extraction without ligature preservation, which saves glyph-mapping work
+PDF_TEXT_FLAGS = pymupdf.TEXTFLAGS_TEXT & ~pymupdf.TEXT_PRESERVE_LIGATURES
+
+# Time allowed for a new extractor process to start and import PyMuPDF; this is
+# not charged to the first page it reads.
+STARTUP_TIMEOUT_SECONDS = 30.0
+
+
+def extract_page_text(page, fast_extract):
+    """Returns the text of a PyMuPDF page, from its text blocks when fast_extract is on."""
+    if fast_extract:
+        # Block tuples are (x0, y0, x1, y1, text, block_no, block_type); type 0 is text
+        return "".join(block[4] for block in page.get_text("blocks", flags=PDF_TEXT_FLAGS) if block[6] == 0)
+    return page.get_text("text", flags=PDF_TEXT_FLAGS)
+
+
+def _serve(conn):
+    """Extractor process main loop.
+
+    Answers each (data, fast_extract, first_page) job with ("opened", page_count),
+    then one ("page", text) message per page from first_page on, so the parent can
+    time every page separately. A page that fails is sent as None; a document that
+    cannot be opened is answered with ("error", message).
+    """
+    conn.send(("ready", None))
+    while True:
+        try:
+            data, fast_extract, first_page = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            doc = pymupdf.open(stream=data, filetype="pdf")
+        except Exception as e:
+            conn.send(("error", str(e)))
+            continue
+
+        try:
+            conn.send(("opened", doc.page_count))
+            for number in range(first_page, doc.page_count):
+                try:
+                    text = extract_page_text(doc[number], fast_extract)
+                except Exception:
+                    text = None
+                conn.send(("page", text))
+        finally:
+            doc.close()
+
+
+class PdfExtractor:
+    """Reads PDFs in a long-lived child process, skipping any page that runs too long.
+
+    When a page takes longer than page_timeout seconds, the process is terminated,
+    a fresh one is started and reading resumes after that page, keeping the pages
+    already read. Instances are safe to share between threads; documents are read
+    one at a time.
+    """
+
+    def __init__(self, page_timeout):
+        self.page_timeout = page_timeout
+        # spawn rather than fork: the Streamlit server is multi-threaded
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+
+    def _start(self):
+        self._conn, child_conn = self._ctx.Pipe()
+        self._process = self._ctx.Process(target=_serve, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+        if self._receive(STARTUP_TIMEOUT_SECONDS) is None:
+            self._stop()
+            raise RuntimeError("PDF extraction process failed to start")
+
+    def _stop(self):
+        self._process.terminate()
+        self._process.join()
+        self._conn.close()
+        self._process = self._conn = None
+
+    def _receive(self, timeout):
+        """Returns the next message from the process, or None if it timed out or exited."""
+        try:
+            if self._conn.poll(timeout):
+                return self._conn.recv()
+        except EOFError:
+            pass
+        return None
+
+    def extract(self, data, fast_extract):
+        """Extracts the text of a PDF from its bytes, one line break between pages.
+
+        Returns (text, skipped_pages), where skipped_pages lists the 1-based numbers
+        of the pages that timed out or failed. Raises TimeoutError if the document
+        cannot be opened within page_timeout, and RuntimeError if it cannot be
+        opened at all.
+        """
+        with self._lock:
+            pages = []
+            skipped_pages = []
+            page_count = None
+            error = None
+            try:
+                while page_count is None or len(pages) < page_count:
+                    if self._process is None or not self._process.is_alive():
+                        if self._process is not None:
+                            self._stop()
+                        self._start()
+                    self._conn.send((data, fast_extract, len(pages)))
+
+                    message = self._receive(self.page_timeout)
+                    if message is None:
+                        raise TimeoutError(f"Opening the PDF took longer than {self.page_timeout}s")
+                    kind, value = message
+                    if kind == "error":
+                        error = value
+                        break
+                    page_count = value
+
+                    while len(pages) < page_count:
+                        message = self._receive(self.page_timeout)
+                        if message is None:
+                            # Too slow, or the process crashed: resume after this page in a fresh process
+                            self._stop()
+                            skipped_pages.append(len(pages) + 1)
+                            pages.append("")
+                            break
+                        text = message[1]
+                        if text is None:
+                            skipped_pages.append(len(pages) + 1)
+                        pages.append(text or "")
+            except BaseException:
+                # Never leave a half-read job in the process for the next caller
+                if self._process is not None:
+                    self._stop()
+                raise
+
+            if error is not None:
+                raise RuntimeError(error)
+            return "\n".join(pages), skipped_pages